@@ -1,18 +1,55 @@
+import asyncio
 import datetime
+import functools
 import logging.config
 from environs import Env
 from seller import download_stock
 
 import requests
 
-from seller import divide, price_conversion
+from seller import (
+    REQUEST_TIMEOUT,
+    convert_prices,
+    create_session,
+    divide,
+    encode_payload,
+    gather_chunks,
+    match_remnants,
+)
 
 logger = logging.getLogger(__file__)
 
+SESSION = create_session()
+ENDPOINT_URL = "https://api.partner.market.yandex.ru"
+PRICES_CHUNK_SIZE = 500
+STOCKS_CHUNK_SIZE = 2000
 
+
+@functools.lru_cache(maxsize=None)
+def get_headers(access_token):
+    """Builds the Yandex Market request headers.
+
+    Args:
+        access_token (str): Employee token
+
+    Returns:
+        dict: Request headers, shared between calls and not to be modified
+
+    """
+    return {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {access_token}",
+        "Accept": "application/json",
+        "Host": "api.partner.market.yandex.ru",
+    }
+
+
+@functools.lru_cache(maxsize=256)
 def get_product_list(page, campaign_id, access_token):
     """Gets a list of Yandex Market store products.
 
+    Pages are cached for the lifetime of the process.
+
     Args:
         page (str): ID of the results page
         campaign_id (int): Campaign ID and Store ID
@@ -45,19 +82,18 @@ def get_product_list(page, campaign_id, access_token):
         }
 
     """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = get_headers(access_token)
     payload = {
         "page_token": page,
         "limit": 200,
     }
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-mapping-entries"
-    response = requests.get(url, headers=headers, params=payload)
+    url = f"{ENDPOINT_URL}/campaigns/{campaign_id}/offer-mapping-entries"
+    response = SESSION.get(
+        url,
+        headers=headers,
+        params=payload,
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
     response_object = response.json()
     return response_object.get("result")
@@ -96,16 +132,15 @@ def update_stocks(stocks, campaign_id, access_token):
             }
 
         """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = get_headers(access_token)
     payload = {"skus": stocks}
-    url = endpoint_url + f"campaigns/{campaign_id}/offers/stocks"
-    response = requests.put(url, headers=headers, json=payload)
+    url = f"{ENDPOINT_URL}/campaigns/{campaign_id}/offers/stocks"
+    response = SESSION.put(
+        url,
+        headers=headers,
+        data=encode_payload(payload),
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
     response_object = response.json()
     return response_object
@@ -144,16 +179,15 @@ def update_price(prices, campaign_id, access_token):
             }
 
         """
-    endpoint_url = "https://api.partner.market.yandex.ru/"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {access_token}",
-        "Accept": "application/json",
-        "Host": "api.partner.market.yandex.ru",
-    }
+    headers = get_headers(access_token)
     payload = {"offers": prices}
-    url = endpoint_url + f"campaigns/{campaign_id}/offer-prices/updates"
-    response = requests.post(url, headers=headers, json=payload)
+    url = f"{ENDPOINT_URL}/campaigns/{campaign_id}/offer-prices/updates"
+    response = SESSION.post(
+        url,
+        headers=headers,
+        data=encode_payload(payload),
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
     response_object = response.json()
     return response_object
@@ -177,16 +211,16 @@ def get_offer_ids(campaign_id, market_token):
 
     """
     page = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(page, campaign_id, market_token)
-        product_list.extend(some_prod.get("offerMappingEntries"))
+        offer_ids.extend(
+            product.get("offer").get("shopSku")
+            for product in some_prod.get("offerMappingEntries")
+        )
         page = some_prod.get("paging").get("nextPageToken")
         if not page:
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer").get("shopSku"))
     return offer_ids
 
 
@@ -194,7 +228,7 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
     """Creates a list of data for each product in the form of its article and number of copies.
 
         Args:
-            watch_remnants (dict): Clock remnants
+            watch_remnants (pandas.DataFrame): Clock remnants
             offer_ids (list): List of product SKUs
             warehouse_id (int): Warehouse ID
 
@@ -220,46 +254,27 @@ def create_stocks(watch_remnants, offer_ids, warehouse_id):
             ]
 
         """
-    stocks = list()
-    date = str(datetime.datetime.utcnow().replace(microsecond=0).isoformat() + "Z")
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append(
+    date = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    codes, counts = match_remnants(watch_remnants, offer_ids)
+    matched = set(codes)
+    leftovers = [offer_id for offer_id in offer_ids if offer_id not in matched]
+    stocks = [
+        {
+            "sku": sku,
+            "warehouseId": warehouse_id,
+            "items": [
                 {
-                    "sku": str(watch.get("Код")),
-                    "warehouseId": warehouse_id,
-                    "items": [
-                        {
-                            "count": stock,
-                            "type": "FIT",
-                            "updatedAt": date,
-                        }
-                    ],
+                    "count": stock,
+                    "type": "FIT",
+                    "updatedAt": date,
                 }
-            )
-            offer_ids.remove(str(watch.get("Код")))
-
-    for offer_id in offer_ids:
-        stocks.append(
-            {
-                "sku": offer_id,
-                "warehouseId": warehouse_id,
-                "items": [
-                    {
-                        "count": 0,
-                        "type": "FIT",
-                        "updatedAt": date,
-                    }
-                ],
-            }
+            ],
+        }
+        for sku, stock in zip(
+            codes.tolist() + leftovers,
+            counts.tolist() + [0] * len(leftovers),
         )
+    ]
     return stocks
 
 
@@ -267,7 +282,7 @@ def create_prices(watch_remnants, offer_ids):
     """Forms the price of goods.
 
         Args:
-            watch_remnants (dict): Clock remnants
+            watch_remnants (pandas.DataFrame): Clock remnants
             offer_ids (list): List of product SKUs
 
         Returns:
@@ -289,33 +304,36 @@ def create_prices(watch_remnants, offer_ids):
 
         """
     prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "id": str(watch.get("Код")),
-                # "feed": {"id": 0},
-                "price": {
-                    "value": int(price_conversion(watch.get("Цена"))),
-                    # "discountBase": 0,
-                    "currencyId": "RUR",
-                    # "vat": 0,
-                },
-                # "marketSku": 0,
-                # "shopSku": "string",
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"].astype(str)
+    in_catalog = codes.isin(set(offer_ids))
+    values = convert_prices(watch_remnants.loc[in_catalog, "Цена"]).astype(int)
+    for code, value in zip(codes[in_catalog].tolist(), values.tolist()):
+        price = {
+            "id": code,
+            # "feed": {"id": 0},
+            "price": {
+                "value": value,
+                # "discountBase": 0,
+                "currencyId": "RUR",
+                # "vat": 0,
+            },
+            # "marketSku": 0,
+            # "shopSku": "string",
+        }
+        prices.append(price)
     return prices
 
 
-async def upload_prices(watch_remnants, campaign_id, market_token):
+async def upload_prices(watch_remnants, campaign_id, market_token, offer_ids=None):
     """Assigns prices for each product.
 
     Returns the new prices for each item.
 
     Args:
-        watch_remnants (dict): Clock remnants
+        watch_remnants (pandas.DataFrame): Clock remnants
         campaign_id (int): Campaign ID and Store ID
         market_token (str): Employee token
+        offer_ids (list): List of product SKUs, fetched when not given
 
     Returns:
         list: Prices data list
@@ -335,21 +353,31 @@ async def upload_prices(watch_remnants, campaign_id, market_token):
         ]
 
         """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(
+            get_offer_ids, campaign_id, market_token
+        )
     prices = create_prices(watch_remnants, offer_ids)
-    for some_prices in list(divide(prices, 500)):
-        update_price(some_prices, campaign_id, market_token)
+    await gather_chunks(
+        update_price,
+        divide(prices, PRICES_CHUNK_SIZE),
+        campaign_id,
+        market_token,
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id):
+async def upload_stocks(
+    watch_remnants, campaign_id, market_token, warehouse_id, offer_ids=None
+):
     """Assigns the remaining quantity for each item.
 
     Args:
-        watch_remnants (dict): Clock remnants
+        watch_remnants (pandas.DataFrame): Clock remnants
         campaign_id (int): Campaign ID and Store ID
         market_token (str): Employee token
         warehouse_id (int): Warehouse ID
+        offer_ids (list): List of product SKUs, fetched when not given
 
     Returns:
         tuple: Products left in stock, Product stocks
@@ -391,16 +419,52 @@ async def upload_stocks(watch_remnants, campaign_id, market_token, warehouse_id)
         )
 
         """
-    offer_ids = get_offer_ids(campaign_id, market_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(
+            get_offer_ids, campaign_id, market_token
+        )
     stocks = create_stocks(watch_remnants, offer_ids, warehouse_id)
-    for some_stock in list(divide(stocks, 2000)):
-        update_stocks(some_stock, campaign_id, market_token)
-    not_empty = list(
-        filter(lambda stock: (stock.get("items")[0].get("count") != 0), stocks)
+    await gather_chunks(
+        update_stocks,
+        divide(stocks, STOCKS_CHUNK_SIZE),
+        campaign_id,
+        market_token,
     )
+    not_empty = [stock for stock in stocks if stock["items"][0]["count"] != 0]
     return not_empty, stocks
 
 
+async def update_campaigns(campaigns, market_token):
+    """Refreshes the stocks and prices of every campaign product.
+
+    The remnants file is downloaded while the SKUs of all campaigns are being
+    fetched.
+
+    Args:
+        campaigns (list): Pairs of Campaign ID and Warehouse ID
+        market_token (str): Employee token
+
+    Raises:
+        requests.exceptions
+
+    """
+    watch_remnants, *campaign_offer_ids = await asyncio.gather(
+        asyncio.to_thread(download_stock),
+        *(
+            asyncio.to_thread(get_offer_ids, campaign_id, market_token)
+            for campaign_id, _ in campaigns
+        ),
+    )
+    for campaign, offer_ids in zip(campaigns, campaign_offer_ids):
+        campaign_id, warehouse_id = campaign
+        # Обновить остатки
+        await upload_stocks(
+            watch_remnants, campaign_id, market_token, warehouse_id, offer_ids
+        )
+        # Поменять цены
+        await upload_prices(watch_remnants, campaign_id, market_token, offer_ids)
+
+
 def main():
     env = Env()
     market_token = env.str("MARKET_TOKEN")
@@ -409,25 +473,14 @@ def main():
     warehouse_fbs_id = env.str("WAREHOUSE_FBS_ID")
     warehouse_dbs_id = env.str("WAREHOUSE_DBS_ID")
 
-    watch_remnants = download_stock()
-    try:
+    campaigns = [
         # FBS
-        offer_ids = get_offer_ids(campaign_fbs_id, market_token)
-        # Обновить остатки FBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_fbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_fbs_id, market_token)
-        # Поменять цены FBS
-        upload_prices(watch_remnants, campaign_fbs_id, market_token)
-
+        (campaign_fbs_id, warehouse_fbs_id),
         # DBS
-        offer_ids = get_offer_ids(campaign_dbs_id, market_token)
-        # Обновить остатки DBS
-        stocks = create_stocks(watch_remnants, offer_ids, warehouse_dbs_id)
-        for some_stock in list(divide(stocks, 2000)):
-            update_stocks(some_stock, campaign_dbs_id, market_token)
-        # Поменять цены DBS
-        upload_prices(watch_remnants, campaign_dbs_id, market_token)
+        (campaign_dbs_id, warehouse_dbs_id),
+    ]
+    try:
+        asyncio.run(update_campaigns(campaigns, market_token))
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error:
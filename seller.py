@@ -1,19 +1,80 @@
+import asyncio
+import functools
 import io
+import json
 import logging.config
-import os
 import re
 import zipfile
 from environs import Env
 
 import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__file__)
 
+UPLOAD_CONCURRENCY = 8
+REQUEST_TIMEOUT = 30
+PRICES_CHUNK_SIZE = 1000
+STOCKS_CHUNK_SIZE = 100
+NON_DIGITS = re.compile("[^0-9]")
+STOCK_OVERRIDES = {">10": 100, "1": 0}
+ENDPOINT_URL = "https://api-seller.ozon.ru"
 
+
+def create_session():
+    """Creates an HTTP session that keeps connections alive between calls.
+
+    Returns:
+        requests.Session: Session with a retrying connection pool of one
+            connection per concurrent upload
+
+    """
+    retries = Retry(
+        total=5,
+        backoff_factor=0.3,
+        status_forcelist=[429, 500, 502, 503, 504],
+    )
+    adapter = HTTPAdapter(
+        pool_maxsize=UPLOAD_CONCURRENCY,
+        pool_block=True,
+        max_retries=retries,
+    )
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+SESSION = create_session()
+
+
+@functools.lru_cache(maxsize=None)
+def get_headers(client_id, seller_token):
+    """Builds the Ozon request headers.
+
+    Args:
+        client_id (str): Client ID
+        seller_token (str): API key
+
+    Returns:
+        dict: Request headers, shared between calls and not to be modified
+
+    """
+    return {
+        "Content-Type": "application/json",
+        "Client-Id": client_id,
+        "Api-Key": seller_token,
+    }
+
+
+@functools.lru_cache(maxsize=256)
 def get_product_list(last_id, client_id, seller_token):
     """Gets a list of Ozone store products.
 
+    Pages are cached for the lifetime of the process.
+
     Args:
         last_id (str): The ID of the last value on the page
         client_id (str): Client ID
@@ -51,11 +112,8 @@ def get_product_list(last_id, client_id, seller_token):
         }
 
     """
-    url = "https://api-seller.ozon.ru/v2/product/list"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
+    url = f"{ENDPOINT_URL}/v2/product/list"
+    headers = get_headers(client_id, seller_token)
     payload = {
         "filter": {
             "visibility": "ALL",
@@ -63,7 +121,12 @@ def get_product_list(last_id, client_id, seller_token):
         "last_id": last_id,
         "limit": 1000,
     }
-    response = requests.post(url, json=payload, headers=headers)
+    response = SESSION.post(
+        url,
+        json=payload,
+        headers=headers,
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
     response_object = response.json()
     return response_object.get("result")
@@ -87,17 +150,15 @@ def get_offer_ids(client_id, seller_token):
 
     """
     last_id = ""
-    product_list = []
+    offer_ids = []
     while True:
         some_prod = get_product_list(last_id, client_id, seller_token)
-        product_list.extend(some_prod.get("items"))
+        items = some_prod.get("items")
+        offer_ids.extend(product.get("offer_id") for product in items)
         total = some_prod.get("total")
         last_id = some_prod.get("last_id")
-        if total == len(product_list):
+        if not items or total == len(offer_ids):
             break
-    offer_ids = []
-    for product in product_list:
-        offer_ids.append(product.get("offer_id"))
     return offer_ids
 
 
@@ -145,13 +206,15 @@ def update_price(prices: list, client_id, seller_token):
         }
 
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/prices"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
+    url = f"{ENDPOINT_URL}/v1/product/import/prices"
+    headers = get_headers(client_id, seller_token)
     payload = {"prices": prices}
-    response = requests.post(url, json=payload, headers=headers)
+    response = SESSION.post(
+        url,
+        data=encode_payload(payload),
+        headers=headers,
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
     return response.json()
 
@@ -195,41 +258,64 @@ def update_stocks(stocks: list, client_id, seller_token):
         }
 
     """
-    url = "https://api-seller.ozon.ru/v1/product/import/stocks"
-    headers = {
-        "Client-Id": client_id,
-        "Api-Key": seller_token,
-    }
+    url = f"{ENDPOINT_URL}/v1/product/import/stocks"
+    headers = get_headers(client_id, seller_token)
     payload = {"stocks": stocks}
-    response = requests.post(url, json=payload, headers=headers)
+    response = SESSION.post(
+        url,
+        data=encode_payload(payload),
+        headers=headers,
+        timeout=REQUEST_TIMEOUT,
+    )
     response.raise_for_status()
     return response.json()
 
 
+def encode_payload(payload):
+    """Serializes the request body to compact UTF-8 JSON.
+
+    Args:
+        payload (dict): Request body
+
+    Returns:
+        bytes: JSON document
+
+    Raises:
+        TypeError
+        ValueError: Out of range float values are not JSON compliant
+
+    Examples:
+        >>> encode_payload({"stocks": [{"offer_id": "136748", "stock": 4}]})
+        b'{"stocks":[{"offer_id":"136748","stock":4}]}'
+
+    """
+    return json.dumps(
+        payload, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
 def download_stock():
     """Downloads the ostatki file from the casio website.
 
     Returns:
-        dict: Clock remnants
+        pandas.DataFrame: Clock remnants
 
     Raises:
         requests.exceptions
 
     """
     casio_url = "https://timeworld.ru/upload/files/ostatki.zip"
-    session = requests.Session()
-    response = session.get(casio_url)
+    response = SESSION.get(casio_url, timeout=REQUEST_TIMEOUT)
     response.raise_for_status()
     with response, zipfile.ZipFile(io.BytesIO(response.content)) as archive:
-        archive.extractall(".")
-    excel_file = "ostatki.xls"
-    watch_remnants = pd.read_excel(
-        io=excel_file,
-        na_values=None,
-        keep_default_na=False,
-        header=17,
-    ).to_dict(orient="records")
-    os.remove("./ostatki.xls")
+        with archive.open("ostatki.xls") as excel_file:
+            watch_remnants = pd.read_excel(
+                io=excel_file,
+                na_values=None,
+                keep_default_na=False,
+                header=17,
+                usecols=["Код", "Количество", "Цена"],
+            )
     return watch_remnants
 
 
@@ -237,7 +323,7 @@ def create_stocks(watch_remnants, offer_ids):
     """Creates a list of data for each product in the form of its article and number of copies.
 
     Args:
-        watch_remnants (dict): Clock remnants
+        watch_remnants (pandas.DataFrame): Clock remnants
         offer_ids (list): List of product SKUs
 
     Returns:
@@ -255,20 +341,16 @@ def create_stocks(watch_remnants, offer_ids):
         ]
 
     """
-    stocks = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            count = str(watch.get("Количество"))
-            if count == ">10":
-                stock = 100
-            elif count == "1":
-                stock = 0
-            else:
-                stock = int(watch.get("Количество"))
-            stocks.append({"offer_id": str(watch.get("Код")), "stock": stock})
-            offer_ids.remove(str(watch.get("Код")))
-    for offer_id in offer_ids:
-        stocks.append({"offer_id": offer_id, "stock": 0})
+    codes, counts = match_remnants(watch_remnants, offer_ids)
+    matched = set(codes)
+    leftovers = [offer_id for offer_id in offer_ids if offer_id not in matched]
+    stocks = [
+        {"offer_id": offer_id, "stock": stock}
+        for offer_id, stock in zip(
+            codes.tolist() + leftovers,
+            counts.tolist() + [0] * len(leftovers),
+        )
+    ]
     return stocks
 
 
@@ -276,7 +358,7 @@ def create_prices(watch_remnants, offer_ids):
     """Forms the price of goods.
 
     Args:
-        watch_remnants (dict): Clock remnants
+        watch_remnants (pandas.DataFrame): Clock remnants
         offer_ids (list): List of product SKUs
 
     Returns:
@@ -298,17 +380,19 @@ def create_prices(watch_remnants, offer_ids):
 
     """
 
-    prices = []
-    for watch in watch_remnants:
-        if str(watch.get("Код")) in offer_ids:
-            price = {
-                "auto_action_enabled": "UNKNOWN",
-                "currency_code": "RUB",
-                "offer_id": str(watch.get("Код")),
-                "old_price": "0",
-                "price": price_conversion(watch.get("Цена")),
-            }
-            prices.append(price)
+    codes = watch_remnants["Код"].astype(str)
+    in_catalog = codes.isin(set(offer_ids))
+    values = convert_prices(watch_remnants.loc[in_catalog, "Цена"])
+    prices = [
+        {
+            "auto_action_enabled": "UNKNOWN",
+            "currency_code": "RUB",
+            "offer_id": code,
+            "old_price": "0",
+            "price": price,
+        }
+        for code, price in zip(codes[in_catalog].tolist(), values.tolist())
+    ]
     return prices
 
 
@@ -330,7 +414,53 @@ def price_conversion(price: str) -> str:
         5990
 
     """
-    return re.sub("[^0-9]", "", price.split(".")[0])
+    return NON_DIGITS.sub("", price.split(".", 1)[0])
+
+
+def convert_prices(prices: pd.Series) -> pd.Series:
+    """Converts a column of prices to a specific format.
+
+    Vectorized counterpart of price_conversion.
+
+    Args:
+        prices (pandas.Series) : Numeric values in string format
+
+    Returns:
+        pandas.Series: Numeric values in string format
+
+    Examples:
+        >>> convert_prices(pd.Series(["5'990.00 руб."])).tolist()
+        ['5990']
+
+    """
+    return (
+        prices.astype(str)
+        .str.split(".", n=1)
+        .str[0]
+        .str.replace(NON_DIGITS, "", regex=True)
+    )
+
+
+def match_remnants(watch_remnants, offer_ids):
+    """Selects the remnants of the store products and their number of copies.
+
+    Each code is taken once, from its first row in the remnants file.
+
+    Args:
+        watch_remnants (pandas.DataFrame): Clock remnants
+        offer_ids (list): List of product SKUs
+
+    Returns:
+        tuple: Product SKUs, Number of copies
+
+    Raises:
+        ValueError: invalid literal for int() with base 10
+
+    """
+    codes = watch_remnants["Код"].astype(str)
+    in_catalog = codes.isin(set(offer_ids)) & ~codes.duplicated()
+    counts = watch_remnants.loc[in_catalog, "Количество"].astype(str)
+    return codes[in_catalog], counts.replace(STOCK_OVERRIDES).astype(int)
 
 
 def divide(lst: list, n: int):
@@ -351,15 +481,41 @@ def divide(lst: list, n: int):
         yield lst[i: i + n]
 
 
-async def upload_prices(watch_remnants, client_id, seller_token):
+async def gather_chunks(func, chunks, *args, limit=UPLOAD_CONCURRENCY):
+    """Calls func for every chunk concurrently in worker threads.
+
+    Args:
+        func (callable): Blocking function taking a chunk and *args
+        chunks (iterable): Parts of the list to send
+        *args: Extra positional arguments for func
+        limit (int): Maximum number of simultaneous calls
+
+    Returns:
+        list: Results of func in the order of chunks
+
+    Raises:
+        requests.exceptions
+
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def send(chunk):
+        async with semaphore:
+            return await asyncio.to_thread(func, chunk, *args)
+
+    return await asyncio.gather(*(send(chunk) for chunk in chunks))
+
+
+async def upload_prices(watch_remnants, client_id, seller_token, offer_ids=None):
     """Assigns prices for each product.
 
     Returns the new prices for each item.
 
     Args:
-        watch_remnants (dict): Clock remnants
+        watch_remnants (pandas.DataFrame): Clock remnants
         client_id (str): Client ID
         seller_token (str): API key
+        offer_ids (list): List of product SKUs, fetched when not given
 
     Returns:
         list: Prices data list
@@ -379,20 +535,28 @@ async def upload_prices(watch_remnants, client_id, seller_token):
         ]
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(
+            get_offer_ids, client_id, seller_token
+        )
     prices = create_prices(watch_remnants, offer_ids)
-    for some_price in list(divide(prices, 1000)):
-        update_price(some_price, client_id, seller_token)
+    await gather_chunks(
+        update_price,
+        divide(prices, PRICES_CHUNK_SIZE),
+        client_id,
+        seller_token,
+    )
     return prices
 
 
-async def upload_stocks(watch_remnants, client_id, seller_token):
+async def upload_stocks(watch_remnants, client_id, seller_token, offer_ids=None):
     """Assigns the remaining quantity for each item.
 
     Args:
-        watch_remnants (dict): Clock remnants
+        watch_remnants (pandas.DataFrame): Clock remnants
         client_id (str): Client ID
         seller_token (str): API key
+        offer_ids (list): List of product SKUs, fetched when not given
 
     Returns:
         tuple: Products left in stock, Product stocks
@@ -419,29 +583,50 @@ async def upload_stocks(watch_remnants, client_id, seller_token):
         )
 
     """
-    offer_ids = get_offer_ids(client_id, seller_token)
+    if offer_ids is None:
+        offer_ids = await asyncio.to_thread(
+            get_offer_ids, client_id, seller_token
+        )
     stocks = create_stocks(watch_remnants, offer_ids)
-    for some_stock in list(divide(stocks, 100)):
-        update_stocks(some_stock, client_id, seller_token)
-    not_empty = list(filter(lambda stock: (stock.get("stock") != 0), stocks))
+    await gather_chunks(
+        update_stocks,
+        divide(stocks, STOCKS_CHUNK_SIZE),
+        client_id,
+        seller_token,
+    )
+    not_empty = [stock for stock in stocks if stock["stock"] != 0]
     return not_empty, stocks
 
 
+async def update_store(client_id, seller_token):
+    """Refreshes the stocks and prices of every store product.
+
+    The remnants file is downloaded while the store SKUs are being fetched.
+
+    Args:
+        client_id (str): Client ID
+        seller_token (str): API key
+
+    Raises:
+        requests.exceptions
+
+    """
+    watch_remnants, offer_ids = await asyncio.gather(
+        asyncio.to_thread(download_stock),
+        asyncio.to_thread(get_offer_ids, client_id, seller_token),
+    )
+    # Обновить остатки
+    await upload_stocks(watch_remnants, client_id, seller_token, offer_ids)
+    # Поменять цены
+    await upload_prices(watch_remnants, client_id, seller_token, offer_ids)
+
+
 def main():
     env = Env()
     seller_token = env.str("SELLER_TOKEN")
     client_id = env.str("CLIENT_ID")
     try:
-        offer_ids = get_offer_ids(client_id, seller_token)
-        watch_remnants = download_stock()
-        # Обновить остатки
-        stocks = create_stocks(watch_remnants, offer_ids)
-        for some_stock in list(divide(stocks, 100)):
-            update_stocks(some_stock, client_id, seller_token)
-        # Поменять цены
-        prices = create_prices(watch_remnants, offer_ids)
-        for some_price in list(divide(prices, 900)):
-            update_price(some_price, client_id, seller_token)
+        asyncio.run(update_store(client_id, seller_token))
     except requests.exceptions.ReadTimeout:
         print("Превышено время ожидания...")
     except requests.exceptions.ConnectionError as error: